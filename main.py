@@ -7,18 +7,39 @@ Level - Игровой бот (single-file SQLite)
 """
 
 import os
+import sys
+import csv
+import gzip
 import json
 import random
 import sqlite3
 import time
 import asyncio
+import signal
+import threading
+import multiprocessing
+from bisect import bisect_right
+from collections import OrderedDict
 from functools import wraps
 from math import sqrt
 from enum import Enum
 from datetime import datetime, timedelta
 
+try:
+    import numpy as np
+except ImportError:  # нужен только для команды rebalance
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # без pyarrow экспорт пишет csv.gz
+    pa = pq = None
+
 from aiogram import Bot, Dispatcher, types
 from aiogram.utils import executor
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputFile
 
 # ----------------- CONFIG -----------------
@@ -36,12 +57,37 @@ VIP_STAR_COST = 5            # кол-во звезд Telegram для заявк
 VIP_DOLLARS_COST = 10_000_000  # стоимость VIP за доллары (запрошено)
 REFERRAL_REWARD_REFERRER = 500
 REFERRAL_REWARD_NEW = 200
+REFERRAL_STATS_DEPTH = 3     # сколько уровней даунлайна показываем в /referrals
 PRICE_COEF = 1.10            # коэффициент повышения цен
 RESET_STARTING = 5000        # стартовый капитал нового игрока
 RESET_STARTING_AFTER_PRESTIGE = 50000
 PRESTIGE_INCOME_MULTIPLIER = 1.5
 FARM_BASE_INCOME = 15
 FARM_UPGRADE_COST_MULTIPLIER = 1.5
+FARM_EXPAND_COST = 10000
+OPTIMISTIC_RETRIES = 5       # попыток списания при конфликте версий строки игрока
+MOD_EFF_INCOME = 0.05        # +5% к доходу с работы за очко eff
+MOD_LUCK_XP = 0.05           # +5% к XP за очко luck
+MOD_JOB_TOOL_INCOME = 0.10   # +10% к доходу профильной работы за очко инструмента ({"mine":1} и т.п.)
+MODIFIER_CACHE_SIZE = 50_000 # сколько игроков держим в LRU-кеше модификаторов
+WORKER_PROCESSES = int(os.getenv("LEVEL_WORKERS", "1"))  # >1 — режим с несколькими процессами-воркерами
+WORKER_HEARTBEAT_TIMEOUT = 30  # сек без heartbeat — воркер считается зависшим и перезапускается
+WORKER_DRAIN_TIMEOUT = 30      # сек на дообработку очереди при остановке
+TX_RETENTION_DAYS = 30         # сколько дней храним сырые строки transactions, старше — сворачиваем по дням
+TX_COMPACT_CHUNK = 5000        # строк за одну короткую транзакцию компактора
+TX_COMPACT_INTERVAL = 3600     # сек между проходами компактора
+TX_VACUUM_PAGES = 2000         # страниц за один PRAGMA incremental_vacuum
+REBALANCE_CHUNK = 5000        # строк на один executemany при записи ребаланса
+EXPORT_DIR = "exports"
+EXPORT_BACKUP_PAGES = 256      # страниц за шаг backup API, между шагами писатели не блокируются
+EXPORT_CHUNK_ROWS = 50_000     # строк в одном чанке (row group / порция csv)
+# таблица -> колонка водяного знака для инкрементального экспорта (None — всегда целиком)
+EXPORT_TABLES = {
+    'players': 'updated_at',
+    'transactions': 'id',
+    'inventory': None,
+    'farm_plots': 'updated_at',  # сбор урожая (harvested=1) меняет строку, а не добавляет новую
+}
 
 # ----------------- ENUMS -----------------
 class JobType(Enum):
@@ -95,6 +141,13 @@ def with_db(func):
 @with_db
 def init_db(conn):
     cur = conn.cursor()
+    # incremental auto-vacuum: освобождённые компактором страницы возвращаются порциями, без долгого VACUUM
+    cur.execute('PRAGMA auto_vacuum')
+    if cur.fetchone()[0] != 2:
+        cur.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        cur.execute('VACUUM')  # для существующего файла режим меняется только через VACUUM (один раз)
+    # WAL: читатели не блокируют писателя, а несколько процессов-воркеров пишут в один файл без "database is locked"
+    cur.execute('PRAGMA journal_mode=WAL')
     # players
     cur.execute('''
     CREATE TABLE IF NOT EXISTS players (
@@ -117,9 +170,23 @@ def init_db(conn):
         farm_level INTEGER DEFAULT 1,
         farm_slots INTEGER DEFAULT 3,
         created_at INTEGER DEFAULT (strftime('%s','now')),
-        updated_at INTEGER DEFAULT (strftime('%s','now'))
+        updated_at INTEGER DEFAULT (strftime('%s','now')),
+        version INTEGER DEFAULT 0
     )
     ''')
+    cur.execute('PRAGMA table_info(players)')
+    if 'version' not in {r['name'] for r in cur.fetchall()}:
+        cur.execute('ALTER TABLE players ADD COLUMN version INTEGER DEFAULT 0')
+    # updated_at держим актуальным для любого писателя — по нему идёт инкрементальный экспорт;
+    # если писатель уже поставил текущую секунду, триггер лишней записи не делает
+    cur.execute('DROP TRIGGER IF EXISTS players_touch')
+    cur.execute('''
+    CREATE TRIGGER players_touch AFTER UPDATE ON players
+    WHEN NEW.updated_at IS OLD.updated_at AND NEW.updated_at IS NOT CAST(strftime('%s','now') AS INTEGER)
+    BEGIN
+        UPDATE players SET updated_at = strftime('%s','now') WHERE user_id = NEW.user_id;
+    END
+    ''')
     
     # farm plots
     cur.execute('''
@@ -130,9 +197,30 @@ def init_db(conn):
         seed_type TEXT,
         planted_at INTEGER,
         harvested INTEGER DEFAULT 0,
+        updated_at INTEGER DEFAULT (strftime('%s','now')),
         FOREIGN KEY(user_id) REFERENCES players(user_id)
     )
     ''')
+    cur.execute('PRAGMA table_info(farm_plots)')
+    if 'updated_at' not in {r['name'] for r in cur.fetchall()}:
+        # ALTER TABLE не умеет неконстантный DEFAULT: добавляем 0 и заполняем из planted_at
+        cur.execute('ALTER TABLE farm_plots ADD COLUMN updated_at INTEGER DEFAULT 0')
+        cur.execute('UPDATE farm_plots SET updated_at = planted_at')
+    cur.execute('''
+    CREATE TRIGGER IF NOT EXISTS farm_plots_touch_insert AFTER INSERT ON farm_plots
+    WHEN NEW.updated_at IS NULL OR NEW.updated_at = 0
+    BEGIN
+        UPDATE farm_plots SET updated_at = strftime('%s','now') WHERE id = NEW.id;
+    END
+    ''')
+    cur.execute('DROP TRIGGER IF EXISTS farm_plots_touch')
+    cur.execute('''
+    CREATE TRIGGER farm_plots_touch AFTER UPDATE ON farm_plots
+    WHEN NEW.updated_at IS OLD.updated_at AND NEW.updated_at IS NOT CAST(strftime('%s','now') AS INTEGER)
+    BEGIN
+        UPDATE farm_plots SET updated_at = strftime('%s','now') WHERE id = NEW.id;
+    END
+    ''')
     
     # items
     cur.execute('''
@@ -231,6 +319,21 @@ def init_db(conn):
         created_at INTEGER DEFAULT (strftime('%s','now'))
     )
     ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_transactions_created ON transactions(created_at)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions(user_id, created_at)')
+    
+    # дневные сводки по старым транзакциям (заполняет компактор)
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS transaction_rollups (
+        user_id INTEGER,
+        day TEXT,
+        type TEXT,
+        currency TEXT,
+        count INTEGER DEFAULT 0,
+        amount REAL DEFAULT 0,
+        PRIMARY KEY(user_id, day, type, currency)
+    )
+    ''')
     
     # referrals table
     cur.execute('''
@@ -246,6 +349,27 @@ def init_db(conn):
     )
     ''')
     
+    # дерево рефералов (closure table): все пары предок-потомок с глубиной >= 1
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS referral_tree (
+        ancestor INTEGER,
+        descendant INTEGER,
+        depth INTEGER,
+        PRIMARY KEY(ancestor, descendant)
+    ) WITHOUT ROWID
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_referral_tree_depth ON referral_tree(ancestor, depth)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_referral_tree_desc ON referral_tree(descendant, depth)')
+    
+    # размер всей сети игрока, поддерживается вместе с referral_tree
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS referral_stats (
+        user_id INTEGER PRIMARY KEY,
+        network_size INTEGER DEFAULT 0
+    )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_referral_stats_size ON referral_stats(network_size)')
+    
     # vip_star_requests
     cur.execute('''
     CREATE TABLE IF NOT EXISTS vip_star_requests (
@@ -269,6 +393,14 @@ def init_db(conn):
     )
     ''')
     
+    # служебные значения (например, кривая уровней, под которую посчитаны xp/lvl игроков)
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS game_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    ''')
+    
     # seed items if empty
     cur.execute('SELECT COUNT(*) as c FROM items')
     if cur.fetchone()['c'] == 0:
@@ -343,6 +475,9 @@ init_db()
 def now_ts():
     return int(time.time())
 
+def is_admin(user_id):
+    return user_id == ADMIN_ID
+
 @with_db
 def ensure_player(conn, user_id, username=None, name=None, ref=None):
     cur = conn.cursor()
@@ -351,12 +486,13 @@ def ensure_player(conn, user_id, username=None, name=None, ref=None):
     if not row:
         cur.execute('INSERT INTO players (user_id, username, name, dollars) VALUES (?, ?, ?, ?)',
                     (user_id, username or '', name or '', RESET_STARTING))
-        if ref:
+        if ref and ref != user_id:  # по своей же ссылке — без реферала и наград
             cur.execute('SELECT * FROM players WHERE user_id=?', (ref,))
             if cur.fetchone():
                 cur.execute('INSERT INTO referrals (referrer, referred, reward_referrer, reward_referred, created_at) VALUES (?, ?, ?, ?, ?)',
                             (ref, user_id, REFERRAL_REWARD_REFERRER, REFERRAL_REWARD_NEW, now_ts()))
                 cur.execute('UPDATE players SET referrals = referrals + 1 WHERE user_id=?', (ref,))
+                add_referral_edge(cur, ref, user_id)
                 cur.execute('UPDATE players SET dollars = dollars + ? WHERE user_id=?', (REFERRAL_REWARD_NEW, user_id))
                 cur.execute('UPDATE players SET dollars = dollars + ? WHERE user_id=?', (REFERRAL_REWARD_REFERRER, ref))
         conn.commit()
@@ -364,6 +500,83 @@ def ensure_player(conn, user_id, username=None, name=None, ref=None):
         row = cur.fetchone()
     return dict(row)
 
+# ----------------- Referral tree -----------------
+def add_referral_edge(cur, referrer, referred):
+    # новый игрок — лист: его предки это referrer и все предки referrer
+    cur.execute('''
+    INSERT OR IGNORE INTO referral_tree (ancestor, descendant, depth)
+    SELECT ancestor, ?, depth + 1 FROM referral_tree WHERE descendant=?
+    UNION ALL SELECT ?, ?, 1
+    ''', (referred, referrer, referrer, referred))
+    cur.execute('''
+    INSERT INTO referral_stats (user_id, network_size)
+    SELECT ancestor, 1 FROM referral_tree WHERE descendant=?
+    ON CONFLICT(user_id) DO UPDATE SET network_size = network_size + 1
+    ''', (referred,))
+
+@with_db
+def get_downline_size(conn, user_id):
+    cur = conn.cursor()
+    cur.execute('SELECT network_size FROM referral_stats WHERE user_id=?', (user_id,))
+    r = cur.fetchone()
+    return r['network_size'] if r else 0
+
+@with_db
+def get_downline_by_depth(conn, user_id, max_depth=REFERRAL_STATS_DEPTH):
+    cur = conn.cursor()
+    cur.execute('SELECT depth, COUNT(*) AS c FROM referral_tree WHERE ancestor=? AND depth<=? GROUP BY depth ORDER BY depth',
+                (user_id, max_depth))
+    return {r['depth']: r['c'] for r in cur.fetchall()}
+
+@with_db
+def get_ancestors(conn, user_id, max_depth=None):
+    # для многоуровневых наград: [(ancestor, depth), ...] от ближайшего
+    cur = conn.cursor()
+    if max_depth is None:
+        cur.execute('SELECT ancestor, depth FROM referral_tree WHERE descendant=? ORDER BY depth', (user_id,))
+    else:
+        cur.execute('SELECT ancestor, depth FROM referral_tree WHERE descendant=? AND depth<=? ORDER BY depth',
+                    (user_id, max_depth))
+    return [(r['ancestor'], r['depth']) for r in cur.fetchall()]
+
+@with_db
+def top_referrers(conn, limit=10):
+    cur = conn.cursor()
+    cur.execute('''
+    SELECT s.user_id, s.network_size, p.username, p.name FROM referral_stats s
+    LEFT JOIN players p ON p.user_id = s.user_id
+    ORDER BY s.network_size DESC LIMIT ?
+    ''', (limit,))
+    return [dict(r) for r in cur.fetchall()]
+
+@with_db
+def rebuild_referral_tree(conn):
+    """Полная пересборка referral_tree/referral_stats из таблицы referrals (для существующих данных)."""
+    cur = conn.cursor()
+    cur.execute('DELETE FROM referral_tree')
+    cur.execute('DELETE FROM referral_stats')
+    # у игрока один пригласивший — берём самую раннюю запись
+    cur.execute('''
+    INSERT OR IGNORE INTO referral_tree (ancestor, descendant, depth)
+    SELECT referrer, referred, 1 FROM referrals
+    WHERE id IN (SELECT MIN(id) FROM referrals GROUP BY referred) AND referrer != referred
+    ''')
+    depth = 1
+    while cur.rowcount > 0:
+        # наращиваем по одному уровню: предки глубины depth + прямые ссылки;
+        # PK(ancestor, descendant) отбрасывает повторы, поэтому и кривые данные с циклами сходятся
+        cur.execute('''
+        INSERT OR IGNORE INTO referral_tree (ancestor, descendant, depth)
+        SELECT t.ancestor, e.descendant, t.depth + 1 FROM referral_tree t
+        JOIN referral_tree e ON e.ancestor = t.descendant AND e.depth = 1
+        WHERE t.depth = ? AND t.ancestor != e.descendant
+        ''', (depth,))
+        depth += 1
+    cur.execute('INSERT INTO referral_stats (user_id, network_size) '
+                'SELECT ancestor, COUNT(*) FROM referral_tree GROUP BY ancestor')
+    cur.execute('SELECT COUNT(*) AS c FROM referral_tree')
+    return cur.fetchone()['c']
+
 @with_db
 def get_player(conn, user_id):
     cur = conn.cursor()
@@ -390,13 +603,289 @@ def list_items(conn, category=None):
         cur.execute('SELECT * FROM items ORDER BY price DESC')
     return [dict(r) for r in cur.fetchall()]
 
-@with_db
-def log_transaction(conn, user_id, ttype, currency, amount, balance_after=None, meta=None):
-    cur = conn.cursor()
+def insert_transaction(cur, user_id, ttype, currency, amount, balance_after=None, meta=None):
+    # запись в журнал внутри уже открытой транзакции вызывающего
     cur.execute('INSERT INTO transactions (user_id, type, currency, amount, balance_after, meta, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
                 (user_id, ttype, currency, amount, balance_after, json.dumps(meta) if meta else None, now_ts()))
     return cur.lastrowid
 
+@with_db
+def log_transaction(conn, user_id, ttype, currency, amount, balance_after=None, meta=None):
+    return insert_transaction(conn.cursor(), user_id, ttype, currency, amount, balance_after, meta)
+
+# ----------------- Transaction retention -----------------
+def tx_retention_cutoff(days=TX_RETENTION_DAYS):
+    # граница по началу суток UTC, чтобы день не делился между сводкой и сырыми строками
+    return (now_ts() // 86400 - days) * 86400
+
+@with_db
+def compact_transactions_chunk(conn, cutoff, chunk=TX_COMPACT_CHUNK):
+    """Сворачивает до chunk самых старых строк до cutoff в transaction_rollups и удаляет их. Возвращает число строк."""
+    cur = conn.cursor()
+    cur.execute('SELECT MAX(id) AS max_id, COUNT(*) AS c FROM '
+                '(SELECT id FROM transactions WHERE created_at < ? ORDER BY id LIMIT ?)', (cutoff, chunk))
+    row = cur.fetchone()
+    if not row['c']:
+        return 0
+    cur.execute('''
+    INSERT INTO transaction_rollups (user_id, day, type, currency, count, amount)
+    SELECT user_id, date(created_at, 'unixepoch'), type, currency, COUNT(*), SUM(amount)
+    FROM transactions WHERE id <= ? AND created_at < ?
+    GROUP BY user_id, date(created_at, 'unixepoch'), type, currency
+    ON CONFLICT(user_id, day, type, currency) DO UPDATE SET
+        count = count + excluded.count, amount = amount + excluded.amount
+    ''', (row['max_id'], cutoff))
+    cur.execute('DELETE FROM transactions WHERE id <= ? AND created_at < ?', (row['max_id'], cutoff))
+    return cur.rowcount
+
+@with_db
+def incremental_vacuum(conn, pages=TX_VACUUM_PAGES):
+    """Возвращает до pages свободных страниц файлу; результат — сколько страниц освобождено."""
+    cur = conn.cursor()
+    cur.execute('PRAGMA freelist_count')
+    before = cur.fetchone()[0]
+    if not before:
+        return 0
+    # через execute() прагма делает только один шаг (одну страницу); executescript доводит её до конца
+    conn.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+    cur.execute('PRAGMA freelist_count')
+    return before - cur.fetchone()[0]
+
+async def transaction_compactor():
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            cutoff = tx_retention_cutoff()
+            total = 0
+            while True:
+                n = await loop.run_in_executor(None, compact_transactions_chunk, cutoff)
+                total += n
+                if n < TX_COMPACT_CHUNK:
+                    break
+                await asyncio.sleep(0.05)  # даём боту писать между чанками
+            # до пустого freelist или пока прогресса нет
+            while await loop.run_in_executor(None, incremental_vacuum) > 0:
+                await asyncio.sleep(0.05)
+            if total:
+                print(f"[compactor] свёрнуто транзакций: {total}")
+        except Exception as e:
+            print(f"[compactor] ошибка: {e!r}")
+        await asyncio.sleep(TX_COMPACT_INTERVAL)
+
+@with_db
+def get_transaction_history(conn, user_id, days=7, recent_limit=10):
+    """Последние сырые операции + дневные итоги за последние days дней (включая сегодня):
+    старые дни берутся из сводок, свежие (и ещё не свёрнутые) — из сырых строк."""
+    cur = conn.cursor()
+    since = (now_ts() // 86400 - (days - 1)) * 86400
+    cur.execute('SELECT type, currency, amount, balance_after, created_at FROM transactions '
+                'WHERE user_id=? ORDER BY id DESC LIMIT ?', (user_id, recent_limit))
+    recent = [dict(r) for r in cur.fetchall()]
+    cur.execute('''
+    SELECT day, type, currency, SUM(count) AS count, SUM(amount) AS amount FROM (
+        SELECT day, type, currency, count, amount FROM transaction_rollups
+        WHERE user_id=? AND day >= date(?, 'unixepoch')
+        UNION ALL
+        SELECT date(created_at, 'unixepoch'), type, currency, 1, amount FROM transactions
+        WHERE user_id=? AND created_at >= ?
+    ) GROUP BY day, type, currency ORDER BY day DESC, type
+    ''', (user_id, since, user_id, since))
+    daily = [dict(r) for r in cur.fetchall()]
+    return {'recent': recent, 'daily': daily}
+
+# ----------------- Analytics export -----------------
+def snapshot_db(dest_path, pages=EXPORT_BACKUP_PAGES):
+    """Согласованная копия живой БД через backup API порциями по pages страниц."""
+    src = sqlite3.connect(DB_FILE)
+    dst = sqlite3.connect(dest_path)
+    try:
+        src.backup(dst, pages=pages, sleep=0.05)
+    finally:
+        dst.close()
+        src.close()
+
+def parquet_schema(conn, table):
+    types_map = {'INTEGER': pa.int64(), 'REAL': pa.float64()}
+    cols = conn.execute(f'PRAGMA table_info({table})').fetchall()
+    return pa.schema([(c['name'], types_map.get(c['type'].upper(), pa.string())) for c in cols])
+
+def export_table(conn, table, out_dir, stamp, since=None):
+    """Потоково выгружает таблицу снапшота чанками. Возвращает (число строк, новый водяной знак)."""
+    mark_col = EXPORT_TABLES[table]
+    if mark_col and since is not None:
+        # по updated_at берём >=, чтобы не потерять строки той же секунды (дубли для измерений допустимы)
+        op = '>=' if mark_col == 'updated_at' else '>'
+        cur = conn.execute(f'SELECT * FROM {table} WHERE {mark_col} {op} ? ORDER BY {mark_col}', (since,))
+    else:
+        cur = conn.execute(f'SELECT * FROM {table}')
+    columns = [d[0] for d in cur.description]
+    mark = since
+    total = 0
+    if pq is not None:
+        path = os.path.join(out_dir, f'{table}_{stamp}.parquet')
+        schema = parquet_schema(conn, table)
+        writer = sink = None
+        try:
+            while True:
+                rows = cur.fetchmany(EXPORT_CHUNK_ROWS)
+                if not rows:
+                    break
+                if writer is None:
+                    sink = open(path, 'xb')  # 'x': чужой файл с тем же именем не перезаписываем
+                    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+                batch = pa.Table.from_pydict({c: [r[i] for r in rows] for i, c in enumerate(columns)}, schema=schema)
+                writer.write_table(batch)
+                total += len(rows)
+                if mark_col:
+                    mark = max(mark or 0, max(r[mark_col] or 0 for r in rows))
+        finally:
+            if writer is not None:
+                writer.close()
+            if sink is not None:
+                sink.close()
+    else:
+        path = os.path.join(out_dir, f'{table}_{stamp}.csv.gz')
+        with gzip.open(path, 'xt', newline='', encoding='utf-8') as f:
+            w = csv.writer(f)
+            w.writerow(columns)
+            while True:
+                rows = cur.fetchmany(EXPORT_CHUNK_ROWS)
+                if not rows:
+                    break
+                w.writerows(tuple(r) for r in rows)
+                total += len(rows)
+                if mark_col:
+                    mark = max(mark or 0, max(r[mark_col] or 0 for r in rows))
+        if total == 0:
+            os.remove(path)  # файл создан этим запуском (режим 'x'), пустой не оставляем
+    return total, mark
+
+def export_analytics(out_dir=EXPORT_DIR, incremental=False):
+    """Снапшот живой БД и выгрузка EXPORT_TABLES; водяные знаки хранятся в out_dir/watermarks.json."""
+    os.makedirs(out_dir, exist_ok=True)
+    marks_path = os.path.join(out_dir, 'watermarks.json')
+    marks = {}
+    if incremental and os.path.exists(marks_path):
+        with open(marks_path) as f:
+            marks = json.load(f)
+
+    stamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S_%f')
+    snap_path = os.path.join(out_dir, f'snapshot_{stamp}.db')
+    if os.path.exists(snap_path):
+        raise FileExistsError(snap_path)
+    snapshot_db(snap_path)
+    conn = sqlite3.connect(snap_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        for table in EXPORT_TABLES:
+            count, mark = export_table(conn, table, out_dir, stamp, marks.get(table) if incremental else None)
+            if mark is not None:
+                marks[table] = mark
+            print(f"[export] {table}: {count} строк")
+    finally:
+        conn.close()
+        os.remove(snap_path)
+
+    with open(marks_path, 'w') as f:
+        json.dump(marks, f)
+    return marks
+
+# ----------------- Item modifiers -----------------
+# Эффекты предметов из инвентаря сворачиваются в один словарь модификаторов на игрока и кешируются;
+# кеш сбрасывается при любом изменении инвентаря (покупка, посадка).
+MOD_ADDITIVE = ('luck', 'eff', 'farm_slots')                       # складываются, с учётом qty
+MOD_MULTIPLICATIVE = ('farm_speed', 'farm_growth', 'farm_income', 'farm_yield')  # перемножаются, по одному на предмет
+MOD_JOB_KEYS = {job.name.lower(): job for job in JobType}
+
+item_effects = {}      # item_id -> (category, dict эффекта); предметы не меняются в рантайме
+modifier_cache = OrderedDict()  # user_id -> модификаторы, LRU на MODIFIER_CACHE_SIZE игроков
+
+def load_item_effects(cur):
+    cur.execute('SELECT id, category, effect FROM items')
+    for r in cur.fetchall():
+        item_effects[r['id']] = (r['category'], json.loads(r['effect'] or '{}'))
+
+def build_modifiers(owned):
+    """owned: [(item_id, qty)] -> модификаторы, применяемые в work_job/harvest_plot/ферме."""
+    add = dict.fromkeys(MOD_ADDITIVE, 0)
+    mul = dict.fromkeys(MOD_MULTIPLICATIVE, 1.0)
+    jobs = {}
+    for item_id, qty in owned:
+        category, effect = item_effects.get(item_id, ('', {}))
+        if category == 'seed':  # семена тратятся при посадке, их farm_income — это множитель семени
+            continue
+        for key, val in effect.items():
+            if key in add:
+                add[key] += val * qty
+            elif key in mul:
+                mul[key] *= val
+            elif key in MOD_JOB_KEYS:
+                job = MOD_JOB_KEYS[key].value
+                jobs[job] = jobs.get(job, 1.0) + MOD_JOB_TOOL_INCOME * val * qty
+    return {
+        'income': 1.0 + MOD_EFF_INCOME * add['eff'],
+        'xp': 1.0 + MOD_LUCK_XP * add['luck'],
+        'jobs': jobs,
+        'grow_time': mul['farm_speed'] * mul['farm_growth'],
+        'farm_income': mul['farm_income'] * mul['farm_yield'],
+        'slots': int(add['farm_slots']),
+    }
+
+def player_modifiers(cur, user_id):
+    mods = modifier_cache.get(user_id)
+    if mods is not None:
+        modifier_cache.move_to_end(user_id)
+        return mods
+    if not item_effects:
+        load_item_effects(cur)
+    cur.execute('SELECT item_id, qty FROM inventory WHERE user_id=? AND qty > 0', (user_id,))
+    mods = modifier_cache[user_id] = build_modifiers([(r['item_id'], r['qty']) for r in cur.fetchall()])
+    if len(modifier_cache) > MODIFIER_CACHE_SIZE:
+        modifier_cache.popitem(last=False)
+    return mods
+
+@with_db
+def get_modifiers(conn, user_id):
+    return player_modifiers(conn.cursor(), user_id)
+
+def invalidate_modifiers(user_id):
+    modifier_cache.pop(user_id, None)
+
+# ----------------- Balance / inventory mutations -----------------
+# Списания без глобальной блокировки: читаем игрока вместе с version, считаем цену и новые значения,
+# затем условный UPDATE (WHERE version=? AND dollars >= ?). Не совпала версия — перечитываем и повторяем.
+def spend_dollars(cur, user_id, plan, retries=OPTIMISTIC_RETRIES):
+    """plan(player) -> (cost, {поле: новое значение}) или строка с ошибкой.
+    Возвращает (True, (player, cost, balance_after)) или (False, сообщение)."""
+    for _ in range(retries):
+        cur.execute('SELECT * FROM players WHERE user_id=?', (user_id,))
+        p = cur.fetchone()
+        if not p:
+            return False, 'Игрок не найден.'
+        res = plan(p)
+        if isinstance(res, str):
+            return False, res
+        cost, fields = res
+        sets = ''.join(f', {k}=?' for k in fields)
+        cur.execute(f'UPDATE players SET dollars = dollars - ?, version = version + 1, updated_at=?{sets} '
+                    'WHERE user_id=? AND version=? AND dollars >= ?',
+                    (cost, now_ts(), *fields.values(), user_id, p['version'], cost))
+        if cur.rowcount:
+            return True, (p, cost, p['dollars'] - cost)
+    return False, 'Слишком много одновременных операций, попробуйте ещё раз.'
+
+def add_item(cur, user_id, item_id, qty=1):
+    cur.execute('INSERT INTO inventory (user_id, item_id, qty) VALUES (?, ?, ?) '
+                'ON CONFLICT(user_id, item_id) DO UPDATE SET qty = qty + excluded.qty', (user_id, item_id, qty))
+    invalidate_modifiers(user_id)
+
+def take_item(cur, user_id, item_id, qty=1):
+    cur.execute('UPDATE inventory SET qty = qty - ? WHERE user_id=? AND item_id=? AND qty >= ?',
+                (qty, user_id, item_id, qty))
+    if cur.rowcount:
+        invalidate_modifiers(user_id)
+    return cur.rowcount > 0
+
 # ----------------- FARM SYSTEM -----------------
 @with_db
 def get_farm_plots(conn, user_id):
@@ -405,13 +894,16 @@ def get_farm_plots(conn, user_id):
     return [dict(r) for r in cur.fetchall()]
 
 @with_db
-def plant_seed(conn, user_id, slot, seed_type):
+def plant_from_inventory(conn, user_id, slot, item_id, seed_type):
+    """Списание семени и посадка одной транзакцией: семя не уйдёт в минус и не пропадёт при занятом слоте."""
     cur = conn.cursor()
-    # Check if slot is available
-    cur.execute('SELECT * FROM farm_plots WHERE user_id=? AND slot=? AND harvested=0', (user_id, slot))
+    if not take_item(cur, user_id, item_id):
+        return False, "У вас нет этого семени"
+    cur.execute('SELECT 1 FROM farm_plots WHERE user_id=? AND slot=? AND harvested=0', (user_id, slot))
     if cur.fetchone():
+        conn.rollback()
+        invalidate_modifiers(user_id)
         return False, "Слот уже занят"
-    
     cur.execute('INSERT INTO farm_plots (user_id, slot, seed_type, planted_at) VALUES (?, ?, ?, ?)',
                 (user_id, slot, seed_type, now_ts()))
     return True, "Семя посажено"
@@ -426,129 +918,244 @@ def harvest_plot(conn, user_id, slot):
     
     seed_type = plot['seed_type']
     planted_at = plot['planted_at']
-    grow_time = next((seed.grow_time for seed in SeedType if seed.name == seed_type), 5)
+    mods = player_modifiers(cur, user_id)
+    grow_time = next((seed.grow_time for seed in SeedType if seed.name == seed_type), 5) * mods['grow_time']
     
     if now_ts() - planted_at < grow_time * 60:  # Convert minutes to seconds
-        return False, f"Ещё не выросло! Осталось: {(grow_time * 60 - (now_ts() - planted_at)) // 60} мин."
+        return False, f"Ещё не выросло! Осталось: {int(grow_time * 60 - (now_ts() - planted_at)) // 60} мин."
+    
+    # условный UPDATE забирает грядку атомарно — параллельный сбор того же урожая получит отказ
+    cur.execute('UPDATE farm_plots SET harvested=1 WHERE id=? AND harvested=0', (plot['id'],))
+    if cur.rowcount == 0:
+        return False, "Нет растения для сбора"
     
     # Calculate income
     seed_data = next((seed for seed in SeedType if seed.name == seed_type), SeedType.WHEAT)
     base_income = FARM_BASE_INCOME
-    farm_level = get_player(user_id)['farm_level']
-    income = int(base_income * seed_data.multiplier * farm_level * (1 + random.random()))
+    cur.execute('SELECT farm_level FROM players WHERE user_id=?', (user_id,))
+    farm_level = cur.fetchone()['farm_level']
+    income = int(base_income * seed_data.multiplier * farm_level * mods['farm_income'] * (1 + random.random()))
     
     # Update player money
-    cur.execute('UPDATE players SET dollars = dollars + ? WHERE user_id=?', (income, user_id))
-    cur.execute('UPDATE farm_plots SET harvested=1 WHERE user_id=? AND slot=?', (user_id, slot))
+    cur.execute('UPDATE players SET dollars = dollars + ?, version = version + 1, updated_at=? WHERE user_id=?',
+                (income, now_ts(), user_id))
     
-    log_transaction(conn, user_id, 'farm_income', 'USD', income, None, {'seed_type': seed_type, 'slot': slot})
+    insert_transaction(cur, user_id, 'farm_income', 'USD', income, None, {'seed_type': seed_type, 'slot': slot})
     return True, f"Собран урожай! Получено {income}$"
 
 @with_db
 def upgrade_farm(conn, user_id):
     cur = conn.cursor()
-    player = get_player(user_id)
-    farm_level = player['farm_level']
-    upgrade_cost = int(5000 * (FARM_UPGRADE_COST_MULTIPLIER ** (farm_level - 1)))
     
-    if player['dollars'] < upgrade_cost:
-        return False, "Недостаточно денег для улучшения"
+    def plan(player):
+        upgrade_cost = int(5000 * (FARM_UPGRADE_COST_MULTIPLIER ** (player['farm_level'] - 1)))
+        if player['dollars'] < upgrade_cost:
+            return "Недостаточно денег для улучшения"
+        return upgrade_cost, {'farm_level': player['farm_level'] + 1}
     
-    cur.execute('UPDATE players SET dollars = dollars - ?, farm_level = farm_level + 1 WHERE user_id=?',
-                (upgrade_cost, user_id))
-    log_transaction(conn, user_id, 'farm_upgrade', 'USD', -upgrade_cost, None, {'new_level': farm_level + 1})
+    ok, res = spend_dollars(cur, user_id, plan)
+    if not ok:
+        return False, res
+    player, upgrade_cost, balance = res
+    farm_level = player['farm_level']
+    insert_transaction(cur, user_id, 'farm_upgrade', 'USD', -upgrade_cost, balance, {'new_level': farm_level + 1})
     return True, f"Ферма улучшена до уровня {farm_level + 1}!"
 
 @with_db
 def expand_farm(conn, user_id):
     cur = conn.cursor()
-    player = get_player(user_id)
-    expand_cost = 10000
     
-    if player['dollars'] < expand_cost:
-        return False, "Недостаточно денег для расширения"
+    def plan(player):
+        if player['dollars'] < FARM_EXPAND_COST:
+            return "Недостаточно денег для расширения"
+        return FARM_EXPAND_COST, {'farm_slots': player['farm_slots'] + 1}
     
-    cur.execute('UPDATE players SET dollars = dollars - ?, farm_slots = farm_slots + 1 WHERE user_id=?',
-                (expand_cost, user_id))
-    log_transaction(conn, user_id, 'farm_expand', 'USD', -expand_cost, None, {'new_slots': player['farm_slots'] + 1})
+    ok, res = spend_dollars(cur, user_id, plan)
+    if not ok:
+        return False, res
+    player, expand_cost, balance = res
+    insert_transaction(cur, user_id, 'farm_expand', 'USD', -expand_cost, balance, {'new_slots': player['farm_slots'] + 1})
     return True, f"Добавлен новый слот! Теперь слотов: {player['farm_slots'] + 1}"
 
 # ----------------- XP / UP / WORK -----------------
 LEVEL_XP = [0, 10, 50, 100, 200, 400, 700, 1000, 1500, 2000, 3000, 5000, 7500, 10000, 15000]
+LEVEL_XP_TAIL_STEP = 2000    # прирост стоимости уровня после конца LEVEL_XP
+LEVEL_TABLE_SIZE = 1000      # сколько уровней держим в предрасчитанной таблице
 def xp_for_next(lvl):
     if lvl < len(LEVEL_XP):
         return LEVEL_XP[lvl]
-    return LEVEL_XP[-1] + (lvl - (len(LEVEL_XP)-1)) * 2000
+    return LEVEL_XP[-1] + (lvl - (len(LEVEL_XP)-1)) * LEVEL_XP_TAIL_STEP
 
-@with_db
-def add_xp(conn, user_id, amount):
-    cur = conn.cursor()
-    cur.execute('SELECT xp, lvl, vip, income_mult FROM players WHERE user_id=?', (user_id,))
-    row = cur.fetchone()
-    if not row:
-        return False, None
-    xp = row['xp'] + (amount * (2 if row['vip'] else 1))
-    lvl = row['lvl']
-    promoted = False
+def build_level_cum_xp(size=LEVEL_TABLE_SIZE):
+    # cum[i] — суммарный XP, нужный чтобы с 1 уровня дойти до уровня i+1
+    cum = [0]
+    for lvl in range(1, size):
+        cum.append(cum[-1] + xp_for_next(lvl))
+    return cum
+
+LEVEL_CUM_XP = build_level_cum_xp()
+
+def apply_xp(lvl, xp, amount):
+    """Возвращает (lvl, xp) после начисления amount XP; xp хранится внутри текущего уровня."""
+    if lvl <= len(LEVEL_CUM_XP):
+        total = LEVEL_CUM_XP[lvl - 1] + xp + amount
+        idx = bisect_right(LEVEL_CUM_XP, total) - 1
+        lvl, xp = idx + 1, total - LEVEL_CUM_XP[idx]
+    else:
+        xp += amount
+    # за пределами таблицы (или на её последнем уровне) досчитываем обычным циклом
     while xp >= xp_for_next(lvl):
         xp -= xp_for_next(lvl)
         lvl += 1
-        promoted = True
-    cur.execute('UPDATE players SET xp=?, lvl=? WHERE user_id=?', (xp, lvl, user_id))
-    return promoted, lvl
+    return lvl, xp
 
-@with_db
-def can_work(conn, user_id):
-    cur = conn.cursor()
-    cur.execute('SELECT last_work, vip FROM players WHERE user_id=?', (user_id,))
-    row = cur.fetchone()
-    if not row:
-        return False, 0
-    cooldown = WORK_COOLDOWN // (2 if row['vip'] else 1)
-    return now_ts() - row['last_work'] >= cooldown, cooldown - (now_ts() - row['last_work'])
-
-@with_db
-def set_last_work(conn, user_id):
-    cur = conn.cursor()
-    cur.execute('UPDATE players SET last_work=? WHERE user_id=?', (now_ts(), user_id))
+JOB_INCOMES = {
+    JobType.FARM: (12, 8),
+    JobType.MINE: (15, 12),
+    JobType.BUILD: (14, 10),
+    JobType.FISH: (10, 6),
+    JobType.WOOD: (13, 9),
+    JobType.HUNT: (16, 14),
+    JobType.COOK: (11, 7),
+    JobType.ART: (18, 15),
+    JobType.TECH: (20, 18),
+    JobType.SPACE: (25, 22)
+}
 
 @with_db
 def work_job(conn, user_id, job_type):
+    """Одно нажатие «работать»: кулдаун, доход, UP, XP/уровень и журнал — одной транзакцией."""
     cur = conn.cursor()
-    cur.execute('SELECT dollars, lvl, vip, up, income_mult FROM players WHERE user_id=?', (user_id,))
+    now = now_ts()
+    vip = is_vip(user_id)  # до первой записи: истёкший VIP снимается отдельным соединением
+    cooldown = WORK_COOLDOWN // (2 if vip else 1)
+    # условный UPDATE забирает кулдаун атомарно — два параллельных нажатия не пройдут оба
+    # updated_at ставим сами, чтобы триггер players_touch не делал лишнюю запись на каждый клик
+    cur.execute('UPDATE players SET last_work=?, updated_at=? WHERE user_id=? AND last_work <= ?',
+                (now, now, user_id, now - cooldown))
+    if cur.rowcount == 0:
+        cur.execute('SELECT last_work FROM players WHERE user_id=?', (user_id,))
+        row = cur.fetchone()
+        if not row:
+            return False, 'Игрок не найден.'
+        return False, f'Пауза. Подожди ещё {cooldown - (now - row["last_work"])} сек.'
+
+    cur.execute('SELECT dollars, xp, lvl, income_mult FROM players WHERE user_id=?', (user_id,))
     p = cur.fetchone()
-    if not p:
-        return False, 'Игрок не найден.'
-    
     lvl = p['lvl']
-    vip = p['vip']
     income_mult = p['income_mult'] or 1.0
     multiplier = (2 if vip else 1) * income_mult
-    
-    # Base income based on job type
-    job_incomes = {
-        JobType.FARM: (12, 8),
-        JobType.MINE: (15, 12),
-        JobType.BUILD: (14, 10),
-        JobType.FISH: (10, 6),
-        JobType.WOOD: (13, 9),
-        JobType.HUNT: (16, 14),
-        JobType.COOK: (11, 7),
-        JobType.ART: (18, 15),
-        JobType.TECH: (20, 18),
-        JobType.SPACE: (25, 22)
-    }
-    
-    base_income, xp_gain = job_incomes.get(job_type, (10, 5))
+
+    mods = player_modifiers(cur, user_id)
+    multiplier *= mods['income'] * mods['jobs'].get(job_type.value, 1.0)
+    base_income, xp_gain = JOB_INCOMES.get(job_type, (10, 5))
+    xp_gain = int(xp_gain * mods['xp'])
     earned = int((base_income + lvl * 2 + random.randint(0, lvl * 3)) * multiplier)
-    
     new_money = max(0, p['dollars'] + earned)
-    cur.execute('UPDATE players SET dollars=?, up = up + 1 WHERE user_id=?', (new_money, user_id))
-    log_transaction(conn, user_id, 'work_income', 'USD', earned, new_money, {'job': job_type.value})
-    add_xp(user_id, xp_gain)
-    
+    new_lvl, new_xp = apply_xp(lvl, p['xp'], xp_gain * (2 if vip else 1))
+
+    cur.execute('UPDATE players SET dollars=?, up = up + 1, xp=?, lvl=?, updated_at=?, version = version + 1 WHERE user_id=?',
+                (new_money, new_xp, new_lvl, now, user_id))
+    insert_transaction(cur, user_id, 'work_income', 'USD', earned, new_money, {'job': job_type.value})
+
     reward_star = random.randint(1, 50) == 1  # 2% chance
-    return True, {'earned': earned, 'xp': xp_gain, 'star': reward_star}
+    return True, {'earned': earned, 'xp': xp_gain, 'star': reward_star, 'lvl_up': new_lvl > lvl, 'lvl': new_lvl}
+
+# ----------------- Progression rebalance -----------------
+def current_level_curve():
+    return {'level_xp': LEVEL_XP, 'tail_step': LEVEL_XP_TAIL_STEP, 'prestige_mult': PRESTIGE_INCOME_MULTIPLIER}
+
+@with_db
+def init_level_curve(conn):
+    # запоминаем кривую, под которую посчитаны текущие xp/lvl — от неё считает rebalance
+    conn.execute('INSERT OR IGNORE INTO game_meta (key, value) VALUES (?, ?)',
+                 ('level_curve', json.dumps(current_level_curve())))
+
+init_level_curve()
+
+def curve_cum_xp(curve, size):
+    # cum[i] — суммарный XP до уровня i+1 по заданной кривой (как LEVEL_CUM_XP, но для любой кривой)
+    level_xp = np.asarray(curve['level_xp'], dtype=np.int64)
+    lvls = np.arange(1, size, dtype=np.int64)
+    tail = level_xp[-1] + (lvls - (len(level_xp) - 1)) * curve['tail_step']
+    costs = np.where(lvls < len(level_xp), level_xp[np.minimum(lvls, len(level_xp) - 1)], tail)
+    return np.concatenate(([0], np.cumsum(costs)))
+
+def rebalance_progression(apply=False, old_curve=None, sample=10):
+    """Пересчитывает xp/lvl/income_mult всех игроков под текущую кривую; без apply — только отчёт."""
+    if np is None:
+        raise RuntimeError("Для ребаланса нужен numpy: pip install numpy")
+    new_curve = current_level_curve()
+
+    conn = get_conn()
+    try:
+        cur = conn.cursor()
+        if apply:
+            # чтение, все чанки и запись новой кривой — одна транзакция с блокировкой записи с самого начала:
+            # XP, начисленный между SELECT и UPDATE, не затрётся, а прерванный прогон откатится целиком
+            cur.execute('BEGIN IMMEDIATE')
+        if old_curve is None:
+            cur.execute('SELECT value FROM game_meta WHERE key=?', ('level_curve',))
+            r = cur.fetchone()
+            old_curve = json.loads(r['value']) if r else new_curve
+        cur.execute('SELECT user_id, xp, lvl, prestige_count, income_mult FROM players')
+        rows = cur.fetchall()
+        if not rows:
+            if apply:
+                cur.execute('INSERT INTO game_meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value',
+                            ('level_curve', json.dumps(new_curve)))
+                conn.commit()
+            return {'players': 0, 'changed': 0, 'promoted': 0, 'demoted': 0, 'sample': []}
+        user_id, xp, lvl, prestige, mult = (np.array(col) for col in zip(*rows))
+        xp = xp.astype(np.int64)
+        lvl = np.maximum(lvl.astype(np.int64), 1)
+        prestige = prestige.astype(np.int64)
+        mult = mult.astype(np.float64)
+
+        old_cum = curve_cum_xp(old_curve, int(lvl.max()) + 1)
+        total = old_cum[lvl - 1] + xp
+        size = max(LEVEL_TABLE_SIZE, int(lvl.max()) + 1)
+        new_cum = curve_cum_xp(new_curve, size)
+        while new_cum[-1] <= total.max():
+            size *= 2
+            new_cum = curve_cum_xp(new_curve, size)
+        idx = np.searchsorted(new_cum, total, side='right') - 1
+        new_lvl = idx + 1
+        new_xp = total - new_cum[idx]
+        new_mult = np.power(float(new_curve['prestige_mult']), prestige)
+
+        changed = np.flatnonzero((new_lvl != lvl) | (new_xp != xp) | ~np.isclose(new_mult, mult))
+        report = {
+            'players': len(rows),
+            'changed': int(changed.size),
+            'promoted': int(np.count_nonzero(new_lvl > lvl)),
+            'demoted': int(np.count_nonzero(new_lvl < lvl)),
+            'sample': [
+                {'user_id': int(user_id[i]), 'lvl': (int(lvl[i]), int(new_lvl[i])), 'xp': (int(xp[i]), int(new_xp[i])),
+                 'income_mult': (float(mult[i]), float(new_mult[i]))}
+                for i in changed[np.argsort(-np.abs(new_lvl[changed] - lvl[changed]), kind='stable')][:sample]
+            ],
+        }
+        if apply:
+            for start in range(0, changed.size, REBALANCE_CHUNK):
+                part = changed[start:start + REBALANCE_CHUNK]
+                cur.executemany('UPDATE players SET xp=?, lvl=?, income_mult=?, version = version + 1 WHERE user_id=?',
+                                zip(new_xp[part].tolist(), new_lvl[part].tolist(),
+                                    new_mult[part].tolist(), user_id[part].tolist()))
+            cur.execute('INSERT INTO game_meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value',
+                        ('level_curve', json.dumps(new_curve)))
+            conn.commit()
+    finally:
+        conn.close()  # без commit (ошибка посреди прогона) транзакция откатывается
+    return report
+
+def format_rebalance_report(report, applied):
+    lines = [f"{'Применено' if applied else 'Пробный прогон'}: игроков {report['players']}, "
+             f"изменится {report['changed']} (вверх {report['promoted']}, вниз {report['demoted']})"]
+    for r in report['sample']:
+        lines.append(f"{r['user_id']}: ур. {r['lvl'][0]}→{r['lvl'][1]}, xp {r['xp'][0]}→{r['xp'][1]}, "
+                     f"x{r['income_mult'][0]:g}→x{r['income_mult'][1]:g}")
+    return "\n".join(lines)
 
 # ----------------- Optimized purchase system -----------------
 @with_db
@@ -559,28 +1166,104 @@ def buy_item_atomic(conn, user_id, item_id):
     if not item:
         return False, 'Товар не найден.'
     
-    cur.execute('SELECT dollars, vip, up FROM players WHERE user_id=?', (user_id,))
-    p = cur.fetchone()
-    if not p:
-        return False, 'Игрок не найден.'
-    
-    price = int(float(item['price']) * (0.8 if p['vip'] else 1.0) * PRICE_COEF)
+    vip = is_vip(user_id)
     
-    if p['dollars'] < price:
-        return False, 'Не хватает денег.'
+    def plan(p):
+        price = int(float(item['price']) * (0.8 if vip else 1.0) * PRICE_COEF)
+        if p['dollars'] < price:
+            return 'Не хватает денег.'
+        return price, {}
     
-    new_balance = p['dollars'] - price
-    cur.execute('UPDATE players SET dollars=? WHERE user_id=?', (new_balance, user_id))
-    cur.execute('INSERT INTO inventory (user_id, item_id, qty) VALUES (?, ?, 1) ON CONFLICT(user_id, item_id) DO UPDATE SET qty = qty + 1',
-                (user_id, item['id']))
+    ok, res = spend_dollars(cur, user_id, plan)
+    if not ok:
+        return False, res
+    _, price, new_balance = res
+    add_item(cur, user_id, item['id'])
     
-    log_transaction(conn, user_id, 'purchase', 'USD', -price, new_balance, {
+    insert_transaction(cur, user_id, 'purchase', 'USD', -price, new_balance, {
         'item_id': item['id'], 
         'item_name': item['name'],
         'rarity': item['rarity']
     })
     return True, f"Куплено {item['name']} за {price}$."
 
+# ----------------- Bans / VIP -----------------
+# Статус бана и VIP держим в памяти процесса: загружаем при старте, дальше меняем только через
+# ban_user / unban_user / grant_vip. В режиме воркеров изменения рассылаются всем процессам через фронт.
+# VIP-зависимые пути (work_job, buy_item_atomic) берут статус через is_vip, а не из players.vip.
+banned_users = set()
+vip_users = {}             # user_id -> vip_until (0 — бессрочно)
+access_sync_queue = None   # в воркере: очередь во фронт для рассылки изменений остальным воркерам
+
+@with_db
+def load_access_state(conn):
+    cur = conn.cursor()
+    cur.execute('SELECT user_id FROM players WHERE banned=1 UNION SELECT user_id FROM bans')
+    banned_users.clear()
+    banned_users.update(r['user_id'] for r in cur.fetchall())
+    cur.execute('SELECT user_id, vip_until FROM players WHERE vip=1 OR vip_until > ?', (now_ts(),))
+    vip_users.clear()
+    vip_users.update((r['user_id'], r['vip_until'] or 0) for r in cur.fetchall())
+
+load_access_state()
+
+def apply_access_change(change):
+    user_id = change['user_id']
+    if change['op'] == 'ban':
+        banned_users.add(user_id)
+    elif change['op'] == 'unban':
+        banned_users.discard(user_id)
+    elif change['op'] == 'vip':
+        vip_users[user_id] = change['until']
+
+def publish_access_change(change):
+    apply_access_change(change)
+    if access_sync_queue is not None:
+        access_sync_queue.put({'access': change})
+
+@with_db
+def expire_vip(conn, user_id):
+    conn.execute('UPDATE players SET vip=0 WHERE user_id=? AND vip_until > 0 AND vip_until <= ?', (user_id, now_ts()))
+
+def is_banned(user_id):
+    return user_id in banned_users
+
+def is_vip(user_id):
+    until = vip_users.get(user_id)
+    if until is None:
+        return False
+    if until == 0 or until > now_ts():
+        return True
+    # срок вышел: снимаем флаг при первом обращении, без фонового опроса БД
+    del vip_users[user_id]
+    expire_vip(user_id)
+    return False
+
+@with_db
+def ban_user(conn, user_id, reason=None, banned_by=None):
+    conn.execute('INSERT OR REPLACE INTO bans (user_id, reason, banned_by, ts) VALUES (?, ?, ?, ?)',
+                 (user_id, reason, banned_by, now_ts()))
+    conn.execute('UPDATE players SET banned=1 WHERE user_id=?', (user_id,))
+    publish_access_change({'op': 'ban', 'user_id': user_id})
+
+@with_db
+def unban_user(conn, user_id):
+    conn.execute('DELETE FROM bans WHERE user_id=?', (user_id,))
+    conn.execute('UPDATE players SET banned=0 WHERE user_id=?', (user_id,))
+    publish_access_change({'op': 'unban', 'user_id': user_id})
+
+@with_db
+def grant_vip(conn, user_id, days):
+    cur = conn.cursor()
+    cur.execute('SELECT vip_until FROM players WHERE user_id=?', (user_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    until = max(row['vip_until'] or 0, now_ts()) + int(days * 86400)
+    cur.execute('UPDATE players SET vip=1, vip_until=? WHERE user_id=?', (until, user_id))
+    publish_access_change({'op': 'vip', 'user_id': user_id, 'until': until})
+    return until
+
 # ----------------- UI Keyboards -----------------
 def main_menu_kb(is_admin_user=False):
     kb = InlineKeyboardMarkup(row_width=2)
@@ -628,14 +1311,15 @@ def farm_kb(user_id):
     kb = InlineKeyboardMarkup(row_width=3)
     
     player = get_player(user_id)
-    max_slots = player['farm_slots']
+    mods = get_modifiers(user_id)
+    max_slots = player['farm_slots'] + mods['slots']
     
     for slot in range(1, max_slots + 1):
         plot = next((p for p in plots if p['slot'] == slot), None)
         if plot:
             seed_type = plot['seed_type']
             planted_time = plot['planted_at']
-            grow_time = next((seed.grow_time for seed in SeedType if seed.name == seed_type), 5)
+            grow_time = next((seed.grow_time for seed in SeedType if seed.name == seed_type), 5) * mods['grow_time']
             progress = min(100, int((now_ts() - planted_time) / (grow_time * 60) * 100))
             kb.insert(InlineKeyboardButton(f"🌱{slot}({progress}%)", callback_data=f"farm_harvest_{slot}"))
         else:
@@ -656,6 +1340,28 @@ def jobs_kb():
     kb.add(InlineKeyboardButton('◀️ Назад', callback_data='main'))
     return kb
 
+# ----------------- Middleware -----------------
+def update_user(update):
+    for key in UPDATE_USER_KEYS:
+        obj = getattr(update, key, None)
+        if obj:
+            return getattr(obj, 'from_user', None) or getattr(obj, 'user', None)
+    return None
+
+class AccessMiddleware(BaseMiddleware):
+    """Отсекает забаненных до хендлеров — по множеству в памяти, без запроса в БД."""
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        user = update_user(update)
+        if user is None:
+            return
+        if is_banned(user.id):
+            if update.callback_query:
+                await update.callback_query.answer('Вы заблокированы.', show_alert=True)
+            raise CancelHandler()
+
+dp.middleware.setup(AccessMiddleware())
+
 # ----------------- Handlers -----------------
 @dp.message_handler(commands=['start'])
 async def cmd_start(message: types.Message):
@@ -682,7 +1388,7 @@ async def farm_menu(call: types.CallbackQuery):
     
     text = (f"🌾 Ваша ферма\n"
             f"Уровень: {player['farm_level']}\n"
-            f"Слотов: {player['farm_slots']}\n"
+            f"Слотов: {player['farm_slots'] + get_modifiers(user_id)['slots']}\n"
             f"Доходность: +{player['farm_level'] * 10}%\n\n"
             f"Выберите действие:")
     
@@ -715,31 +1421,9 @@ async def plant_seed_handler(call: types.CallbackQuery):
         await call.answer("Семя не найдено")
         return
     
-    # Check if player has the seed
-    @with_db
-    def check_inventory(conn):
-        cur = conn.cursor()
-        cur.execute('SELECT qty FROM inventory WHERE user_id=? AND item_id=?', (user_id, item_id))
-        return cur.fetchone()
-    
-    inv = check_inventory()
-    if not inv or inv['qty'] <= 0:
-        await call.answer("У вас нет этого семени")
-        return
-    
-    # Plant the seed
-    success, message = plant_seed(user_id, slot, item['name'])
-    if success:
-        # Remove seed from inventory
-        @with_db
-        def remove_seed(conn):
-            cur = conn.cursor()
-            cur.execute('UPDATE inventory SET qty = qty - 1 WHERE user_id=? AND item_id=?', (user_id, item_id))
-        
-        remove_seed()
-        await call.answer(message)
-    else:
-        await call.answer(message)
+    # Списываем семя и сажаем одной транзакцией
+    success, message = plant_from_inventory(user_id, slot, item_id, item['name'])
+    await call.answer(message)
     
     await call.message.edit_text("Обновляем ферму...", reply_markup=farm_kb(user_id))
 
@@ -755,7 +1439,7 @@ async def farm_harvest(call: types.CallbackQuery):
         player = get_player(user_id)
         new_text = (f"🌾 Ваша ферма\n"
                    f"Уровень: {player['farm_level']}\n"
-                   f"Слотов: {player['farm_slots']}\n"
+                   f"Слотов: {player['farm_slots'] + get_modifiers(user_id)['slots']}\n"
                    f"Баланс: {int(player['dollars'])}$\n\n"
                    f"{message}")
         await call.message.edit_text(new_text, reply_markup=farm_kb(user_id))
@@ -770,7 +1454,7 @@ async def farm_upgrade_handler(call: types.CallbackQuery):
         player = get_player(user_id)
         text = (f"🌾 Ваша ферма\n"
                f"Уровень: {player['farm_level']}\n"
-               f"Слотов: {player['farm_slots']}\n"
+               f"Слотов: {player['farm_slots'] + get_modifiers(user_id)['slots']}\n"
                f"Баланс: {int(player['dollars'])}$\n\n"
                f"{message}")
         await call.message.edit_text(text, reply_markup=farm_kb(user_id))
@@ -785,7 +1469,7 @@ async def farm_expand_handler(call: types.CallbackQuery):
         player = get_player(user_id)
         text = (f"🌾 Ваша ферма\n"
                f"Уровень: {player['farm_level']}\n"
-               f"Слотов: {player['farm_slots']}\n"
+               f"Слотов: {player['farm_slots'] + get_modifiers(user_id)['slots']}\n"
                f"Баланс: {int(player['dollars'])}$\n\n"
                f"{message}")
         await call.message.edit_text(text, reply_markup=farm_kb(user_id))
@@ -800,12 +1484,6 @@ async def job_handler(call: types.CallbackQuery):
     user_id = call.from_user.id
     job_type = call.data.split('_', 1)[1]
     
-    ok, info = can_work(user_id)
-    if not ok:
-        await call.answer(f'Пауза. Подожди ещё {info} сек.', show_alert=True)
-        return
-    
-    set_last_work(user_id)
     success, res = work_job(user_id, JobType(job_type))
     
     if not success:
@@ -820,11 +1498,85 @@ async def job_handler(call: types.CallbackQuery):
            f'💵 Заработано: {earned}$\n'
            f'📈 XP: +{xp}\n')
     
+    if res['lvl_up']:
+        msg += f'🎉 Новый уровень: {res["lvl"]}!\n'
+    
     if star:
         msg += '⭐ Вы получили шанс на звезду Telegram!'
     
     await call.message.edit_text(msg, reply_markup=main_menu_kb(is_admin_user=is_admin(user_id)))
 
+@dp.message_handler(commands=['history'])
+async def cmd_history(message: types.Message):
+    history = get_transaction_history(message.from_user.id)
+    lines = ["📜 Последние операции:"]
+    for tx in history['recent']:
+        ts = datetime.utcfromtimestamp(tx['created_at']).strftime('%d.%m %H:%M')
+        lines.append(f"{ts} {tx['type']}: {int(tx['amount']):+}$")
+    if not history['recent']:
+        lines.append("пока пусто")
+    if history['daily']:
+        lines.append("\n📊 Итоги по дням:")
+        for d in history['daily']:
+            lines.append(f"{d['day']} {d['type']}: {d['count']} шт., {int(d['amount']):+}$")
+    await message.answer("\n".join(lines))
+
+@dp.message_handler(commands=['referrals'])
+async def cmd_referrals(message: types.Message):
+    user_id = message.from_user.id
+    by_depth = get_downline_by_depth(user_id)
+    lines = [f"👥 Ваша сеть: {get_downline_size(user_id)} чел."]
+    for depth in range(1, REFERRAL_STATS_DEPTH + 1):
+        lines.append(f"Уровень {depth}: {by_depth.get(depth, 0)}")
+    lines.append("\n🏆 Топ по размеру сети:")
+    for i, r in enumerate(top_referrers(), 1):
+        lines.append(f"{i}. {r['name'] or r['username'] or r['user_id']} — {r['network_size']}")
+    await message.answer("\n".join(lines))
+
+@dp.message_handler(commands=['rebalance'])
+async def cmd_rebalance(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    apply = message.get_args().strip() == 'apply'
+    loop = asyncio.get_running_loop()
+    try:
+        report = await loop.run_in_executor(None, lambda: rebalance_progression(apply=apply))
+    except RuntimeError as e:
+        await message.answer(str(e))
+        return
+    text = format_rebalance_report(report, apply)
+    if not apply:
+        text += "\n\nПрименить: /rebalance apply"
+    await message.answer(text)
+
+@dp.message_handler(commands=['ban', 'unban', 'vip'])
+async def cmd_access_admin(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    args = message.get_args().split(maxsplit=1)
+    if not args or not args[0].isdigit():
+        await message.answer("Использование: /ban <id> [причина], /unban <id>, /vip <id> <дней>")
+        return
+    user_id = int(args[0])
+    command = message.get_command(pure=True)
+    if command == 'ban':
+        ban_user(user_id, args[1] if len(args) > 1 else None, message.from_user.id)
+        await message.answer(f"Игрок {user_id} заблокирован.")
+    elif command == 'unban':
+        unban_user(user_id)
+        await message.answer(f"Игрок {user_id} разблокирован.")
+    else:
+        try:
+            days = float(args[1]) if len(args) > 1 else 30
+        except ValueError:
+            await message.answer("Укажите число дней.")
+            return
+        until = grant_vip(user_id, days)
+        if until is None:
+            await message.answer("Игрок не найден.")
+            return
+        await message.answer(f"VIP для {user_id} до {datetime.utcfromtimestamp(until):%d.%m.%Y %H:%M} UTC.")
+
 @dp.callback_query_handler(lambda c: c.data == 'shop')
 async def shop_menu(call: types.CallbackQuery):
     await call.message.edit_text("Выберите категорию товаров:", reply_markup=shop_kb())
@@ -863,9 +1615,205 @@ async def shop_category(call: types.CallbackQuery):
     kb.add(InlineKeyboardButton('◀️ Назад', callback_data='shop'))
     await call.message.edit_text(f"{category_names.get(category, 'Товары')}:", reply_markup=kb)
 
+# ----------------- Multi-process mode -----------------
+# Фронт-процесс получает апдейты через getUpdates и раскладывает их по воркерам
+# по from_user.id, так что апдейты одного игрока всегда идут в один процесс и по порядку.
+UPDATE_USER_KEYS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                    'shipping_query', 'pre_checkout_query', 'poll_answer', 'my_chat_member', 'chat_member',
+                    'chat_join_request')
+
+def update_route_key(data):
+    for key in UPDATE_USER_KEYS:
+        obj = data.get(key)
+        if obj:
+            user = obj.get('from') or obj.get('user')
+            if user:
+                return user['id']
+    return data.get('update_id', 0)
+
+def worker_main(index, queue, heartbeat, control):
+    global access_sync_queue
+    # Ctrl+C и systemd шлют сигнал всей группе процессов; воркер завершается только по сигналу
+    # остановки из очереди (после дообработки) или по kill() от фронта
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    access_sync_queue = control
+    asyncio.run(worker_loop(index, queue, heartbeat))
+
+async def worker_loop(index, queue, heartbeat):
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    loop = asyncio.get_running_loop()
+    tails = {}  # user_id -> последняя задача игрока, новые апдейты ждут её завершения
+
+    async def beat():
+        while True:
+            heartbeat.value = time.time()
+            await asyncio.sleep(1)
+
+    async def process(key, data, prev):
+        if prev is not None:
+            await asyncio.gather(prev, return_exceptions=True)
+        try:
+            # через updates_handler, чтобы отработали middleware уровня update
+            await dp.process_updates([types.Update.to_object(data)])
+        except Exception as e:
+            print(f"[worker {index}] ошибка обработки апдейта {data.get('update_id')}: {e!r}")
+        finally:
+            if tails.get(key) is asyncio.current_task():
+                del tails[key]
+
+    beater = asyncio.create_task(beat())
+    try:
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:  # сигнал на остановку: дообрабатываем то, что уже взяли
+                break
+            if 'access' in data:  # бан/VIP, изменённые в другом воркере
+                apply_access_change(data['access'])
+                continue
+            key = update_route_key(data)
+            tails[key] = asyncio.create_task(process(key, data, tails.get(key)))
+        if tails:
+            await asyncio.gather(*tails.values(), return_exceptions=True)
+    finally:
+        beater.cancel()
+        await bot.close()
+
+class WorkerPool:
+    def __init__(self, size):
+        self.ctx = multiprocessing.get_context('spawn')  # чистый процесс без унаследованной aiohttp-сессии
+        self.size = size
+        self.queues = [self.ctx.Queue() for _ in range(size)]
+        self.heartbeats = [self.ctx.Value('d', 0.0) for _ in range(size)]
+        self.procs = [None] * size
+        self.control = self.ctx.Queue()  # изменения бан/VIP от воркеров, рассылаются всем
+        self.queues_lock = threading.Lock()  # замена очереди в check_health vs рассылка из forward_control
+        threading.Thread(target=self.forward_control, name="level-access-sync", daemon=True).start()
+
+    def forward_control(self):
+        while True:
+            msg = self.control.get()
+            with self.queues_lock:
+                for q in self.queues:
+                    q.put(msg)
+
+    def start_worker(self, index):
+        self.heartbeats[index].value = time.time()
+        proc = self.ctx.Process(target=worker_main, args=(index, self.queues[index], self.heartbeats[index], self.control),
+                                name=f"level-worker-{index}", daemon=True)
+        proc.start()
+        self.procs[index] = proc
+
+    def start(self):
+        for i in range(self.size):
+            self.start_worker(i)
+
+    def dispatch(self, data):
+        self.queues[update_route_key(data) % self.size].put(data)
+
+    def check_health(self):
+        now = time.time()
+        for i, proc in enumerate(self.procs):
+            stale = now - self.heartbeats[i].value > WORKER_HEARTBEAT_TIMEOUT
+            if proc.is_alive() and not stale:
+                continue
+            print(f"[pool] воркер {i} {'завис' if proc.is_alive() else 'упал'} (exitcode={proc.exitcode}), перезапуск")
+            if proc.is_alive():
+                proc.kill()
+            proc.join(timeout=5)
+            # процесс мог умереть внутри queue.get() с захваченной блокировкой чтения — такая очередь
+            # больше никому не отдаст данные, поэтому новому воркеру даём новую, а неразобранные апдейты
+            # старой очереди теряются (их нельзя вычитать, не повиснув на той же блокировке)
+            old = self.queues[i]
+            try:
+                lost = old.qsize()
+            except NotImplementedError:
+                lost = '?'
+            print(f"[pool] воркер {i}: потеряно апдейтов в старой очереди: {lost}")
+            with self.queues_lock:
+                old.cancel_join_thread()
+                old.close()
+                self.queues[i] = self.ctx.Queue()
+            self.start_worker(i)
+
+    def drain(self, timeout=WORKER_DRAIN_TIMEOUT):
+        for q in self.queues:
+            q.put(None)
+        deadline = time.time() + timeout
+        for i, proc in enumerate(self.procs):
+            proc.join(timeout=max(0, deadline - time.time()))
+            if proc.is_alive():
+                print(f"[pool] воркер {i} не успел завершиться, останавливаем")
+                proc.kill()  # SIGTERM воркер игнорирует
+                proc.join(timeout=5)
+
+async def run_multiprocess(workers):
+    pool = WorkerPool(workers)
+    pool.start()
+    compactor = asyncio.create_task(transaction_compactor())  # только во фронт-процессе
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await dp.skip_updates()
+    offset = None
+    last_health = time.time()
+    try:
+        while not stop.is_set():
+            poll = asyncio.create_task(bot.get_updates(offset=offset, timeout=20))
+            waiter = asyncio.create_task(stop.wait())
+            done, _ = await asyncio.wait({poll, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            if poll not in done:
+                poll.cancel()
+                break
+            try:
+                updates = poll.result()
+            except Exception as e:
+                print(f"[pool] ошибка getUpdates: {e!r}")
+                await asyncio.sleep(1)
+                updates = []
+            for update in updates:
+                pool.dispatch(update.to_python())
+                offset = update.update_id + 1
+            if time.time() - last_health >= 5:
+                pool.check_health()
+                last_health = time.time()
+        if offset is not None:
+            await bot.get_updates(offset=offset, timeout=0, limit=1)  # подтверждаем уже розданные апдейты
+    finally:
+        compactor.cancel()
+        await loop.run_in_executor(None, pool.drain)
+        await bot.close()
+
 # ----------------- Run bot -----------------
+compactor_task = None  # сильная ссылка: asyncio держит задачи только через weakref
+
+async def on_startup(dp):
+    global compactor_task
+    compactor_task = asyncio.create_task(transaction_compactor())
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'export':
+        # python main.py export [папка] [--incremental]
+        args = [a for a in sys.argv[2:] if not a.startswith('--')]
+        export_analytics(args[0] if args else EXPORT_DIR, incremental='--incremental' in sys.argv)
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'rebalance':
+        # python main.py rebalance [--apply]
+        apply = '--apply' in sys.argv
+        print(format_rebalance_report(rebalance_progression(apply=apply), apply))
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'rebuild_referrals':
+        print(f"Пересобрано связей в дереве рефералов: {rebuild_referral_tree()}")
+        sys.exit(0)
     print("Запуск Level - Игровой бот (SQLite single-file)")
     print("Добавлена расширенная система фермы с уникальными семенами")
     print("Добавлены новые работы и улучшения")
-    executor.start_polling(dp, skip_updates=True)
+    if WORKER_PROCESSES > 1:
+        print(f"Режим воркеров: {WORKER_PROCESSES} процессов")
+        asyncio.run(run_multiprocess(WORKER_PROCESSES))
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup)